@@ -1,10 +1,22 @@
-from os import symlink
+import hashlib
+import json
+from functools import lru_cache
+from glob import glob
+from os import remove, replace, stat, symlink
 from os.path import (dirname, abspath, join, exists)
 from pathlib import Path
 
 import yaml
 from SCAutolib import env_logger
 
+# Use LibYAML-backed loader/dumper when the C extension is available as it is
+# significantly faster than the pure-Python one. Configuration files contain
+# only plain scalars, lists and maps, so safe loader semantic is sufficient.
+try:
+    from yaml import CSafeLoader as _YamlLoader, CSafeDumper as _YamlDumper
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader, SafeDumper as _YamlDumper
+
 DIR_PATH = dirname(abspath(__file__))
 SETUP_IPA_SERVER = f"{DIR_PATH}/env/ipa-install-server.sh"
 LIB_DIR = "/etc/SCAutolib"
@@ -16,6 +28,61 @@ LIB_BACKUP = join(LIB_DIR, "backup")
 LIB_KEYS = join(LIB_DIR, "keys")
 LIB_CERTS = join(LIB_DIR, "certs")
 
+# Cache for parsed YAML configuration files. Key is (path, mtime, size) of
+# the file, so any modification of the file on the disk invalidates the
+# corresponding entry and the file would be parsed again on the next read.
+_YAML_CACHE = {}
+
+
+def _load_config_cached(path):
+    """Load YAML file from given path. Parsed content is cached, so repeated
+    reads of the same unchanged file do not parse it again. Additionally,
+    parsed content is stored next to the file as a JSON sidecar file named by
+    a fingerprint of the YAML content, so other processes (e.g. subsequent CLI
+    invocations) can load the much cheaper JSON instead of re-parsing YAML.
+
+    :param path: path to the file in YAML format to be loaded
+
+    :return parsed content of the file
+    """
+    file_stat = stat(path)
+    key = (path, file_stat.st_mtime_ns, file_stat.st_size)
+    if key in _YAML_CACHE:
+        return _YAML_CACHE[key]
+
+    with open(path, "rb") as file:
+        raw_content = file.read()
+    fingerprint = hashlib.blake2b(raw_content, digest_size=16).hexdigest()
+    sidecar = f"{path}.{fingerprint}.json"
+    if exists(sidecar):
+        with open(sidecar, "r") as file:
+            data = json.load(file)
+    else:
+        data = yaml.load(raw_content, Loader=_YamlLoader)
+        # Sidecar is only an optimization: the config may live in a
+        # directory we can't write to (e.g. read-only mount), so a failed
+        # cache write must never fail the read itself.
+        try:
+            for stale_sidecar in glob(f"{path}.*.json"):
+                remove(stale_sidecar)
+            with open(f"{sidecar}.tmp", "w") as file:
+                json.dump(data, file)
+            replace(f"{sidecar}.tmp", sidecar)
+        except OSError:
+            env_logger.debug(f"Can't write JSON sidecar for {path}. Skip.")
+    _YAML_CACHE[key] = data
+    return data
+
+
+def _drop_config_cache(path):
+    """Remove all cached entries for given path from the YAML cache. Has to be
+    called before the file is overwritten to not serve stale content.
+
+    :param path: path to the file to be removed from the cache
+    """
+    for key in [k for k in _YAML_CACHE if k[0] == path]:
+        _YAML_CACHE.pop(key)
+
 
 def init_config(user_config=None, config_content: dict = None):
     """Initialize configuration files to be used in the library. Function
@@ -35,7 +102,7 @@ def init_config(user_config=None, config_content: dict = None):
             env_logger.debug(f"Default configuration is used: {config_content}")
 
         with open(LIB_CONF, "w") as f:
-            yaml.dump(config_content, f)
+            yaml.dump(config_content, f, Dumper=_YamlDumper)
         env_logger.debug("Library internal configuration file is created in "
                          f"{LIB_CONF}")
     if not exists(CONF) and user_config is not None:
@@ -44,6 +111,37 @@ def init_config(user_config=None, config_content: dict = None):
                            f"{CONF} -> {user_config}")
 
 
+@lru_cache(maxsize=256)
+def _compile_path(item):
+    """Split dotted configuration key (a.b.c) into a tuple of its parts.
+    Compiled tuples are cached per key string, so repeated lookups of the
+    same key skip the split.
+
+    :param item: dotted configuration key
+
+    :return tuple with parts of the key
+    """
+    return tuple(item.split("."))
+
+
+def load_config(which="user", config_file=None) -> dict:
+    """
+    Load the configuration file and return its full parsed content. Content
+    is cached, so the file is parsed only once per process and call sites can
+    dereference as many keys as needed without re-reading the file.
+
+    :param which: define which configuration file to read: library
+    internal or user configuration file
+    :param config_file: path to custom specific file in YAML format to read
+    from
+
+    :return parsed content of the configuration file
+    """
+    if config_file is None:
+        config_file = CONF if which == "user" else LIB_CONF
+    return _load_config_cached(config_file)
+
+
 def read_config(*items, cast=None, which="user", config_file=None) \
         -> list or object:
     """
@@ -61,30 +159,25 @@ def read_config(*items, cast=None, which="user", config_file=None) \
     :return list with required items
 
     """
-    if config_file is None:
-        config_file = CONF if which == "user" else LIB_CONF
-    with open(config_file, "r") as file:
-        config_data = yaml.load(file, Loader=yaml.FullLoader)
-        assert config_data, "Data are not loaded correctly."
+    config_data = load_config(which=which, config_file=config_file)
+    assert config_data, "Data are not loaded correctly."
 
     if len(items) == 0:
         return config_data
 
     return_list = []
     for item in items:
-        parts = item.split(".")
         value = config_data
-        for part in parts:
+        for part in _compile_path(item):
             if value is None:
                 env_logger.warning(
                     f"Key {part} not present in the configuration file. Skip.")
                 return None
 
             value = value.get(part)
-            if part == parts[-1]:
-                if cast is not None:
-                    value = cast(value)
-                return_list.append(value)
+        if cast is not None:
+            value = cast(value)
+        return_list.append(value)
 
     return return_list if len(items) > 1 else return_list[0]
 
@@ -105,8 +198,7 @@ def set_config(path, value, action="replace", type_=str):
 
     config_data = {}
     if exists(LIB_CONF):
-        with open(LIB_CONF, "r") as file:
-            config_data = yaml.load(file, Loader=yaml.FullLoader)
+        config_data = _load_config_cached(LIB_CONF)
     obj = config_data
     key_list = path.split(".")
 
@@ -133,7 +225,8 @@ def set_config(path, value, action="replace", type_=str):
         else:
             obj[key_list[-1]] = [obj[key_list[-1]], value]
 
+    _drop_config_cache(LIB_CONF)
     with open(LIB_CONF, "w") as f:
-        yaml.dump(config_data, f)
+        yaml.dump(config_data, f, Dumper=_YamlDumper)
 
     env_logger.debug(f"Value for filed {path} is update to {value}")
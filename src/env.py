@@ -1,46 +1,41 @@
+import atexit
+import crypt
 import os
+import shlex
 import subprocess
+import threading
 from configparser import ConfigParser
+from io import StringIO
 from os import chmod, remove
 from os.path import exists
 from pathlib import Path
 from posixpath import join
 from shutil import rmtree, copytree, copyfile
-from subprocess import PIPE, Popen, CalledProcessError
+from subprocess import PIPE, CalledProcessError
 from traceback import format_exc
 
-import paramiko
 import pwd
-import python_freeipa as pipa
 import yaml
-from SCAutolib.src import (utils, env_logger, read_config, SETUP_IPA_SERVER,
-                           set_config, LIB_CONF, LIB_CA, LIB_BACKUP,
-                           LIB_KEYS, LIB_CERTS, LIB_DIR)
+from SCAutolib.src import (utils, env_logger, read_config, load_config,
+                           SETUP_IPA_SERVER, set_config, LIB_CONF, LIB_CA,
+                           LIB_BACKUP, LIB_KEYS, LIB_CERTS, LIB_DIR,
+                           _load_config_cached, _drop_config_cache,
+                           _YamlDumper)
 from SCAutolib.src.exceptions import UnspecifiedParameter, SCAutolibException
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from fabric import Connection
-from invoke import Responder
 
+# NOTE: heavy third-party modules (python_freeipa, cryptography, paramiko,
+# fabric) are imported lazily inside the functions that need them, so CLI
+# commands that do not touch IPA or certificates do not pay their import
+# cost on startup.
 
-def create_cnf(user: str, conf_dir=None):
-    """
-    Create configuration files for OpenSSL to generate certificates and requests
-    by local CA.
-
-    Args:
-        user: username for which CNF should be created. If user = ca, then cnf
-              would be created for CA.
-        conf_dir: directory where CNF file would be placed.
-    """
-    if user == "ca":
-        conf_dir = join(LIB_CA, "conf")
-
-        ca_cnf = f"""[ ca ]
+# OpenSSL configuration templates for local CA and user certificate requests.
+# Defined once on module level, so they are not rebuilt on every create_cnf
+# call.
+_CA_CNF_TEMPLATE = """[ ca ]
 default_ca = CA_default
 
 [ CA_default ]
-dir              = {LIB_CA}
+dir              = {ca_dir}
 database         = $dir/index.txt
 new_certs_dir    = $dir/newcerts
 
@@ -85,13 +80,7 @@ OU = Example Test
 CN = Example Test CA
 """
 
-        with open(f"{conf_dir}/ca.cnf", "w") as f:
-            f.write(ca_cnf)
-            env_logger.debug(
-                f"Configuration file for local CA is created {conf_dir}/ca.cnf")
-        return f"{conf_dir}/ca.cnf"
-
-    user_cnf = f"""
+_USER_CNF_TEMPLATE = """
 [ req ]
 distinguished_name = req_distinguished_name
 prompt = no
@@ -110,14 +99,55 @@ keyUsage = critical, nonRepudiation, digitalSignature
 extendedKeyUsage = clientAuth, emailProtection, msSmartcardLogin
 subjectAltName = otherName:msUPN;UTF8:{user}@EXAMPLE.COM, email:{user}@example.com
 """  # noqa: E501
+
+
+def _write_config_file(path: str, content: str, mode=0o644):
+    """Write the whole content of a configuration file with a single write
+    call instead of multiple small buffered writes. Content is written to a
+    temporary file which is renamed over the target, so the replacement is
+    atomic and hard-linked backups of the old file stay intact.
+
+    Args:
+        path: path of the file to be (over)written.
+        content: full content of the file.
+        mode: permissions for the file if it has to be created.
+    """
+    tmp_path = f"{path}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        os.write(fd, content.encode())
+    finally:
+        os.close(fd)
+    os.replace(tmp_path, path)
+
+
+def create_cnf(user: str, conf_dir=None):
+    """
+    Create configuration files for OpenSSL to generate certificates and requests
+    by local CA.
+
+    Args:
+        user: username for which CNF should be created. If user = ca, then cnf
+              would be created for CA.
+        conf_dir: directory where CNF file would be placed.
+    """
+    if user == "ca":
+        conf_dir = join(LIB_CA, "conf")
+
+        cnf_path = join(conf_dir, "ca.cnf")
+        _write_config_file(cnf_path, _CA_CNF_TEMPLATE.format(ca_dir=LIB_CA))
+        env_logger.debug("Configuration file for local CA is created "
+                         "%s", cnf_path)
+        return cnf_path
+
     if conf_dir is None:
         raise UnspecifiedParameter(
             "conf_dir", "Directory with configurations is not provided")
-    with open(f"{conf_dir}/req_{user}.cnf", "w") as f:
-        f.write(user_cnf)
-        env_logger.debug(f"Configuration file for CSR for user {user} is "
-                         f"created  {conf_dir}/req_{user}.cnf")
-    return f"{conf_dir}/req_{user}.cnf"
+    cnf_path = join(conf_dir, f"req_{user}.cnf")
+    _write_config_file(cnf_path, _USER_CNF_TEMPLATE.format(user=user))
+    env_logger.debug("Configuration file for CSR for user %s is created  "
+                     "%s", user, cnf_path)
+    return cnf_path
 
 
 def create_sssd_config():
@@ -155,11 +185,12 @@ def create_sssd_config():
     for section in cnf.sections():
         cnf.set(section, 'debug_level', '9')
 
-    with open(sssd_conf, "w") as f:
-        cnf.write(f)
-        env_logger.debug("Configuration file for SSSD is updated "
-                         "in  /etc/sssd/sssd.conf")
+    buf = StringIO()
+    cnf.write(buf)
+    _write_config_file(sssd_conf, buf.getvalue(), mode=0o600)
     chmod(sssd_conf, 0o600)
+    env_logger.debug("Configuration file for SSSD is updated "
+                     "in  /etc/sssd/sssd.conf")
 
 
 def create_softhsm2_config(card_dir: str):
@@ -168,15 +199,16 @@ def create_softhsm2_config(card_dir: str):
     in setup-ca function, otherwise configuration file wouldn't be found causing
     the error. conf_dir expected to be in work_dir.
     """
-    conf_dir = f"{card_dir}/conf"
+    conf_path = join(card_dir, "conf", "softhsm2.conf")
 
-    with open(f"{conf_dir}/softhsm2.conf", "w") as f:
-        f.write(f"directories.tokendir = {card_dir}/tokens/\n"
-                f"slots.removable = true\n"
-                f"objectstore.backend = file\n"
-                f"log.level = INFO\n")
-        env_logger.debug(f"Configuration file for SoftHSM2 is created "
-                         f"in {conf_dir}/softhsm2.conf.")
+    _write_config_file(
+        conf_path,
+        f"directories.tokendir = {join(card_dir, 'tokens')}/\n"
+        f"slots.removable = true\n"
+        f"objectstore.backend = file\n"
+        f"log.level = INFO\n")
+    env_logger.debug("Configuration file for SoftHSM2 is created in "
+                     "%s.", conf_path)
 
 
 def create_virt_card_service(username: str, card_dir: str):
@@ -190,13 +222,13 @@ def create_virt_card_service(username: str, card_dir: str):
                    the service file).s
     """
     path = f"/etc/systemd/system/virt_cacard_{username}.service"
-    conf_dir = f"{card_dir}/conf"
+    conf_dir = join(card_dir, "conf")
     default = {
         "Unit": {
             "Description": f"virtual card for {username}",
             "Requires": "pcscd.service"},
         "Service": {
-            "Environment": f'SOFTHSM2_CONF="{conf_dir}/softhsm2.conf"',
+            "Environment": f'SOFTHSM2_CONF="{join(conf_dir, "softhsm2.conf")}"',
             "WorkingDirectory": card_dir,
             "ExecStart":
                 "/usr/bin/virt_cacard >> /var/log/virt_cacard.debug 2>&1",
@@ -211,11 +243,12 @@ def create_virt_card_service(username: str, card_dir: str):
         destination = utils.backup_(path)
         add_restore("file", path, destination)
 
-    with open(path, "w") as f:
-        cnf.read_dict(default)
-        cnf.write(f)
-    env_logger.debug(f"Service file {path} for user '{username}' "
-                     "is created.")
+    cnf.read_dict(default)
+    buf = StringIO()
+    cnf.write(buf)
+    _write_config_file(path, buf.getvalue())
+    env_logger.debug("Service file %s for user '%s' is created.",
+                     path, username)
 
 
 def setup_ca_():
@@ -232,10 +265,10 @@ def setup_ca_():
     try:
         if exists(LIB_CA):
             # FIXME restore CA directory
-            env_logger.warning(f"CA directory {LIB_CA} alredy exists.")
+            env_logger.warning("CA directory %s alredy exists.", LIB_CA)
             rmtree(LIB_CA)
-            env_logger.warning(f"CA directory is deleted. A new one would "
-                               f"be created in {LIB_CA}")
+            env_logger.warning("CA directory is deleted. A new one would be "
+                               "created in %s", LIB_CA)
         for d in (LIB_CA, certs, crl, conf_dir, newcerts):
             create_dir(d, conf=False)
 
@@ -254,14 +287,14 @@ def setup_ca_():
              join(LIB_CA, "rootCA.key"), '-sha256', '-set_serial', '0',
              '-extensions', 'v3_ca', '-out',
              join(LIB_CA, "rootCA.pem")])
-        env_logger.debug(
-            f"Key for local CA is created {join(LIB_CA, 'rootCA.key')}")
-        env_logger.debug(
-            f"Certificate for local CA is created {join(LIB_CA,'rootCA.pem')}")
+        env_logger.debug("Key for local CA is created "
+                         "%s", join(LIB_CA, "rootCA.key"))
+        env_logger.debug("Certificate for local CA is created "
+                         "%s", join(LIB_CA, "rootCA.pem"))
 
         run(['openssl', 'ca', '-config', join(conf_dir, 'ca.cnf'), '-gencrl',
              '-out', join(LIB_CA, "crl", "root.crl")])
-        env_logger.debug(f"CRL is created {crl}")
+        env_logger.debug("CRL is created %s", crl)
 
         with open(join(LIB_CA, "rootCA.pem"), "r") as f_cert:
             root_cert = f_cert.read()
@@ -286,6 +319,33 @@ def setup_ca_():
         exit(1)
 
 
+# Serialize rewriting of pcscd.service and restarting of system services
+# when virtual smart cards are set up for several users in parallel.
+_PCSCD_SERVICE_LOCK = threading.Lock()
+_SERVICES_LOCK = threading.Lock()
+
+
+def prepare_pcscd_service():
+    """Install pcscd.service with removed --auto-exit option to
+    /etc/systemd/system. The unit is user-independent and the function is
+    idempotent: when the installed unit already has the expected content,
+    nothing is written and no daemon-reload is issued, so parallel card
+    setups pay for it only once.
+    """
+    with _PCSCD_SERVICE_LOCK:
+        with open("/usr/lib/systemd/system/pcscd.service", "r") as f:
+            data = f.read().replace("--auto-exit", "")
+        service = "/etc/systemd/system/pcscd.service"
+        if exists(service):
+            with open(service, "r") as f:
+                if f.read() == data:
+                    return
+        with open(service, "w") as f:
+            f.write(data)
+        run_batch(["systemctl daemon-reload", "systemctl restart pcscd"])
+        env_logger.debug("pcscd.service is updated")
+
+
 def setup_virt_card_(user: dict):
     """
     Executes setup script fot virtual smart card
@@ -313,53 +373,24 @@ def setup_virt_card_(user: dict):
     if user["local"]:
         try:
             pwd.getpwnam(username)
+            env_logger.debug("Local user %s already exists on the "
+                             "system", username)
         except KeyError:
-            run(["useradd", username, "-m", ])
-            env_logger.debug(f"Local user {username} is added to the system "
-                             f"with a password {passwd}")
-        finally:
-            with Popen(['passwd', username, '--stdin'], stdin=PIPE,
-                       stderr=PIPE, encoding="utf-8") as proc:
-                proc.communicate(passwd)
+            hashed = crypt.crypt(passwd, crypt.mksalt(crypt.METHOD_SHA512))
+            run(["useradd", username, "-m", "-p", hashed])
             add_restore("user", user)
-            env_logger.debug(
-                f"Password for user {username} is updated to {passwd}")
+            env_logger.debug("Local user %s is added to the system with a "
+                             "password %s", username, passwd)
         cnf_file = create_cnf(username, conf_dir=user_conf_dir)
 
-        cnf = ConfigParser()
-        cnf.optionxform = str
-        with open("/etc/sssd/sssd.conf", "r") as f:
-            cnf.read_file(f)
-
-        if f"certmap/shadowutils/{username}" not in cnf.sections():
-            cnf.add_section(f"certmap/shadowutils/{username}")
-
-        cnf.set(f"certmap/shadowutils/{username}", "matchrule",
-                f"<SUBJECT>.*CN={username}.*")
-        with open("/etc/sssd/sssd.conf", "w") as f:
-            cnf.write(f)
-        env_logger.debug(
-            "Match rule for local user is added to /etc/sssd/sssd.conf")
-
-    env_logger.debug(f"Start setup of virtual smart card for user {username} "
-                     f"in {card_dir}")
+    env_logger.debug("Start setup of virtual smart card for user %s in "
+                     "%s", username, card_dir)
     try:
-        if not exists(join(user_conf_dir, "softhsm2.conf")):
-            env_logger.warning(
-                f"SoftHSM config is missing in the {user_conf_dir}. Creating...")
+        if not exists(softhsm_conf):
+            env_logger.warning("SoftHSM config is missing in the %s. "
+                               "Creating...", user_conf_dir)
             create_softhsm2_config(card_dir)
 
-        with open("/usr/lib/systemd/system/pcscd.service", "r") as f:
-            data = f.read()
-        data = data.replace("--auto-exit", "")
-        with open("/etc/systemd/system/pcscd.service", "w") as f:
-            f.write(data)
-
-        run("systemctl daemon-reload")
-        run("systemctl restart pcscd")
-
-        env_logger.debug("pcscd.service is updated")
-
         run(["softhsm2-util", "--init-token", "--free", "--label", "SC test",
              "--so-pin", sopin, "--pin", pin],
             env={"SOFTHSM2_CONF": softhsm_conf})
@@ -380,42 +411,46 @@ def setup_virt_card_(user: dict):
             run(["openssl", "req", "-new", "-nodes", "-key", key,
                  "-reqexts", "req_exts", "-config", cnf_file, "-out", csr])
 
-            env_logger.debug(f"User CSR is created {csr} using {cnf_file}")
+            env_logger.debug("User CSR is created %s using %s", csr, cnf_file)
 
             run(["openssl", "ca", "-config", join(LIB_CA, "conf", "ca.cnf"),
                  "-batch", "-keyfile", join(LIB_CA, "rootCA.key"), "-in", csr,
                  "-notext", "-days", "365", "-extensions", "usr_cert",
                  "-out", cert])
-            env_logger.debug(f"User certificates is created {cert}.")
+            env_logger.debug("User certificates is created %s.", cert)
 
         run(["pkcs11-tool", "--module", "libsofthsm2.so", "--slot-index", "0",
              "-w", key, "-y", "privkey", "--label", f"'{username}'", "-p", pin,
              "--set-id", "0", "-d", "0"], env={"SOFTHSM2_CONF": softhsm_conf})
-        env_logger.debug(f"User key {key} is added to SoftHSM token")
+        env_logger.debug("User key %s is added to SoftHSM token", key)
 
         run(['pkcs11-tool', '--module', 'libsofthsm2.so', '--slot-index', '0',
              '-w', cert, '-y', 'cert', '--label', f"'{username}'", '-p', pin,
              '--set-id', '0', '-d', '0'], env={"SOFTHSM2_CONF": softhsm_conf})
 
-        env_logger.debug(
-            f"User certificate {cert} is added to SoftHSM token")
+        env_logger.debug("User certificate %s is added to SoftHSM token", cert)
 
-        run("systemctl daemon-reload")
-        with open("/usr/share/p11-kit/modules/opensc.module", "r") as f:
-            data = f.read()
-        if "disable-in: virt_cacard" not in data:
-            with open("/usr/share/p11-kit/modules/opensc.module", "a") as f:
-                f.write("disable-in: virt_cacard\n")
-            env_logger.debug("opensc.module is updated")
-
-        run(['systemctl', 'stop', 'pcscd.service', 'pcscd.socket',
-             f'virt_cacard_{username}', 'sssd'])
-        rmtree("/var/lib/sss/mc/*", ignore_errors=True)
-        rmtree("/var/lib/sss/db/*", ignore_errors=True)
-        env_logger.debug(
-            "Directories /var/lib/sss/mc/ and /var/lib/sss/db/ removed")
-        run("systemctl start pcscd sssd")
-        env_logger.debug("Services start, pcscd, sssd are restarted")
+        # Stopping/starting shared services and clearing the sssd caches
+        # affects all users, so one worker can't interrupt the sequence of
+        # the other one.
+        with _SERVICES_LOCK:
+            run("systemctl daemon-reload")
+            with open("/usr/share/p11-kit/modules/opensc.module", "r") as f:
+                data = f.read()
+            if "disable-in: virt_cacard" not in data:
+                with open("/usr/share/p11-kit/modules/opensc.module",
+                          "a") as f:
+                    f.write("disable-in: virt_cacard\n")
+                env_logger.debug("opensc.module is updated")
+
+            run(['systemctl', 'stop', 'pcscd.service', 'pcscd.socket',
+                 f'virt_cacard_{username}', 'sssd'])
+            rmtree("/var/lib/sss/mc/*", ignore_errors=True)
+            rmtree("/var/lib/sss/db/*", ignore_errors=True)
+            env_logger.debug(
+                "Directories /var/lib/sss/mc/ and /var/lib/sss/db/ removed")
+            run("systemctl start pcscd sssd")
+            env_logger.debug("Services start, pcscd, sssd are restarted")
 
     except:
         env_logger.error(format_exc())
@@ -423,27 +458,70 @@ def setup_virt_card_(user: dict):
         raise
 
 
+# Serializes read-modify-write cycles on sssd.conf when users are set up
+# in parallel.
+_SSSD_CONF_LOCK = threading.Lock()
+
+
+def add_sssd_certmap(usernames: list):
+    """Add certificate mapping rules for given local users to sssd.conf.
+    The file is parsed and written back only once for the whole list.
+
+    Args:
+        usernames: list of usernames of local users for which match rule
+                   should be added.
+    """
+    with _SSSD_CONF_LOCK:
+        cnf = ConfigParser()
+        cnf.optionxform = str
+        with open("/etc/sssd/sssd.conf", "r") as f:
+            cnf.read_file(f)
+
+        for username in usernames:
+            section = f"certmap/shadowutils/{username}"
+            if section not in cnf.sections():
+                cnf.add_section(section)
+            cnf.set(section, "matchrule", f"<SUBJECT>.*CN={username}.*")
+
+        buf = StringIO()
+        cnf.write(buf)
+        _write_config_file("/etc/sssd/sssd.conf", buf.getvalue(), mode=0o600)
+    env_logger.debug(
+        "Match rules for local users are added to /etc/sssd/sssd.conf")
+
+
 def check_semodule():
     """Checks if specific SELinux module for virtual smart card is installed.
     This is implemented be checking the hardcoded name for the module
     (virtcacard) to be present in the list of SELinux modules. If this name is
     not present in the list, then virtcacard.cil file would be created in conf
     or subdirectory in the CA directory specified by the configuration file.
+
+    A successful check leaves a marker file in the conf sub-directory of the
+    CA directory, so subsequent runs skip the semodule shell-out. The marker
+    is removed together with the CA directory, so a fresh environment always
+    re-checks the module.
     """
-    result = run("semodule -l", print_=False)
-    if "virtcacard" not in result.stdout:
+    marker = join(LIB_CA, "conf", ".virtcacard_installed")
+    if exists(marker):
+        env_logger.debug("SELinux module for virtual smart cards is "
+                         "installed (cached result)")
+        return
+    result = run(["bash", "-c", "semodule -l | grep -q virtcacard"],
+                 print_=False)
+    if result.returncode != 0:
         env_logger.debug(
             "SELinux module for virtual smart cards is not present in the "
             "system. Installing...")
-        conf_dir = join(LIB_CA, 'conf')
+        cil_path = join(LIB_CA, 'conf', 'virtcacard.cil')
         module = """
 (allow pcscd_t node_t(tcp_socket(node_bind)))
 ;; allow p11_child to read softhsm cache - not present in RHEL by default
 (allow sssd_t named_cache_t(dir(read search)))"""
-        with open(f"{conf_dir}/virtcacard.cil", "w") as f:
+        with open(cil_path, "w") as f:
             f.write(module)
         try:
-            run(["semodule", "-i", f"{conf_dir}/virtcacard.cil"], check=True)
+            run(["semodule", "-i", cil_path], check=True)
         except CalledProcessError:
             env_logger.error("Error while installing SELinux module "
                              "for virt_cacard")
@@ -456,6 +534,8 @@ def check_semodule():
         except CalledProcessError:
             env_logger.error("Error while restarting the pcscd service")
             raise
+    if exists(join(LIB_CA, "conf")):
+        Path(marker).touch()
     env_logger.debug(
         "SELinux module for virtual smart cards is installed")
 
@@ -469,10 +549,10 @@ def create_dir(dir_path: str, conf=True):
               directory (default True).
      """
     Path(dir_path).mkdir(parents=True, exist_ok=True)
-    env_logger.debug(f"Directory {dir_path} is created")
+    env_logger.debug("Directory %s is created", dir_path)
     if conf:
         Path(join(dir_path, "conf")).mkdir(parents=True, exist_ok=True)
-        env_logger.debug(f"Directory {join(dir_path, 'conf')} is created")
+        env_logger.debug("Directory %s is created", join(dir_path, "conf"))
 
 
 def prepare_dirs():
@@ -481,9 +561,10 @@ def prepare_dirs():
     previously loaded env file.
     """
 
-    paths = (LIB_CA, LIB_BACKUP, LIB_KEYS, LIB_CERTS, join(LIB_CA, "conf"))
+    paths = {LIB_CA, LIB_BACKUP, LIB_KEYS, LIB_CERTS, join(LIB_CA, "conf")}
     for path in paths:
-        create_dir(path, conf=False)
+        os.makedirs(path, exist_ok=True)
+    env_logger.debug("Directories for test environment are created: %s", paths)
 
 
 def install_ipa_client_(ip: str, passwd: str, server_hostname: str = None):
@@ -496,15 +577,20 @@ def install_ipa_client_(ip: str, passwd: str, server_hostname: str = None):
                 with root and for obtaining admin kerberos ticket on the server.
         server_hostname: hostname of IPA server
     """
+    import paramiko
+    from fabric import Connection
+    from invoke import Responder
+
     env_logger.debug("Start installation of IPA client")
+    cfg = load_config()
     if server_hostname is None:
-        server_hostname = read_config("ipa_server_hostname")
+        server_hostname = cfg.get("ipa_server_hostname")
 
-    client_hostname = read_config("ipa_client_hostname")
+    client_hostname = cfg.get("ipa_client_hostname")
     entry = f"{ip} {server_hostname}"
-    domain = read_config("ipa_domain")
-    realm = read_config("ipa_realm")
-    admin_passwd = read_config("ipa_server_admin_passwd")
+    domain = cfg.get("ipa_domain")
+    realm = cfg.get("ipa_realm")
+    admin_passwd = cfg.get("ipa_server_admin_passwd")
     ipa_client_script = join(LIB_DIR, "ipa-client-sc.sh")
     with open("/etc/hosts", "r") as f:
         data = f.read()
@@ -512,14 +598,14 @@ def install_ipa_client_(ip: str, passwd: str, server_hostname: str = None):
     if entry not in data:
         with open("/etc/hosts", "a") as f:
             f.write(f"{entry}\n")
-        env_logger.debug(f"New entry {entry} is added to /etc/hosts")
+        env_logger.debug("New entry %s is added to /etc/hosts", entry)
 
     try:
         with open("/etc/resolv.conf", "r") as f:
             data = f.read()
         if f"nameserver {ip}" not in data:
-            env_logger.debug(f"Nameserver {ip} is not present in "
-                             f"/etc/resolve.conf. Adding...")
+            env_logger.debug("Nameserver %s is not present in "
+                             "/etc/resolve.conf. Adding...", ip)
             data = f"nameserver {ip}\n" + data
             with open("/etc/resolv.conf", "w") as f:
                 f.write(data)
@@ -528,11 +614,10 @@ def install_ipa_client_(ip: str, passwd: str, server_hostname: str = None):
         env_logger.debug(
             "IPA server is added to /etc/resolv.conf as first nameserver")
 
-        run("chattr -i /etc/resolv.conf")
+        run_batch(["chattr -i /etc/resolv.conf",
+                   f"hostnamectl set-hostname {client_hostname} --static"])
         env_logger.debug("File /etc/resolv.conf is blocked for editing")
-
-        run(f"hostnamectl set-hostname {client_hostname} --static")
-        env_logger.debug(f"Hostname is set to {client_hostname}")
+        env_logger.debug("Hostname is set to %s", client_hostname)
 
         run(["ipa-client-install", "-p", "admin", "--password", admin_passwd,
              "--server", server_hostname, "--domain", domain, "--realm",
@@ -545,8 +630,9 @@ def install_ipa_client_(ip: str, passwd: str, server_hostname: str = None):
             cnf.read_file(f)
         cnf.set('sssd', 'certificate_verification', 'no_ocsp')
 
-        with open('/etc/sssd/sssd.conf', "w") as f:
-            cnf.write(f)
+        buf = StringIO()
+        cnf.write(buf)
+        _write_config_file('/etc/sssd/sssd.conf', buf.getvalue(), mode=0o600)
         env_logger.debug(
             "SSSD is update for no_ocsp for certificate verification")
         run("systemctl restart sssd")
@@ -580,7 +666,7 @@ def install_ipa_client_(ip: str, passwd: str, server_hostname: str = None):
             raise SCAutolibException(msg)
 
         env_logger.debug("File for setting up IPA client for smart cards is "
-                         f"copied to {ipa_client_script}")
+                         "copied to %s", ipa_client_script)
 
         run(f'bash {ipa_client_script} /etc/ipa/ca.crt')
 
@@ -613,17 +699,25 @@ def add_ipa_user_(user: dict, ipa_hostname: str = None):
         ipa_hostname: hostname of IPA server. If non, tries to read
                       ipa_server_hostname field from the configuration file
     """
+    import python_freeipa as pipa
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
     username, user_dir, passwd = user["name"], user["card_dir"], user["passwd"]
     cert_path = user["cert"] if "cert" in user.keys(
-    ) else f"{user_dir}/cert.pem"
+    ) else join(user_dir, "cert.pem")
     key_path = user["key"] if "key" in user.keys(
-    ) else f"{user_dir}/private.key"
-    csr_path = user["csr"] if "csr" in user.keys() else f"{user_dir}/cert.csr"
-    env_logger.debug(f"Adding user {username} to IPA server")
-    ipa_admin_passwd = read_config("ipa_server_admin_passwd")
+    ) else join(user_dir, "private.key")
+    csr_path = user["csr"] if "csr" in user.keys(
+    ) else join(user_dir, "cert.csr")
+    env_logger.debug("Adding user %s to IPA server", username)
+    cfg = load_config()
+    ipa_admin_passwd = cfg.get("ipa_server_admin_passwd")
     default_passwd = "redhat"
     if ipa_hostname is None:
-        ipa_hostname = read_config("ipa_server_hostname")
+        ipa_hostname = cfg.get("ipa_server_hostname")
         if ipa_hostname is None:
             raise UnspecifiedParameter("ipa_server_hostname")
 
@@ -633,11 +727,11 @@ def add_ipa_user_(user: dict, ipa_hostname: str = None):
         client_meta.user_add(username, username, username, username,
                              o_userpassword=default_passwd)
     except pipa.exceptions.DuplicateEntry:
-        env_logger.error(
-            f"User {username} already exists on the IPA server {ipa_hostname}.")
+        env_logger.error("User %s already exists on the IPA server "
+                         "%s.", username, ipa_hostname)
         raise
-    env_logger.debug(f"User {username} is added to the IPA server with default "
-                     f"password '{default_passwd}'")
+    env_logger.debug("User %s is added to the IPA server with default "
+                     "password '%s'", username, default_passwd)
     key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
 
     create_dir(user_dir)
@@ -647,23 +741,24 @@ def add_ipa_user_(user: dict, ipa_hostname: str = None):
             encoding=serialization.Encoding.PEM,
             format=serialization.PrivateFormat.TraditionalOpenSSL,
             encryption_algorithm=serialization.NoEncryption()))
-    env_logger.debug(f"Private key is created in {key_path}")
-    try:
-        run(["openssl", "req", "-new", "-days", "365",
-             "-nodes", "-key", key_path, "-out",
-             csr_path, "-subj", f"/CN={username}"])
-    except CalledProcessError:
-        env_logger.error(f"Error while generating CSR for user {username}")
-        raise
+    env_logger.debug("Private key is created in %s", key_path)
+
+    csr = x509.CertificateSigningRequestBuilder() \
+        .subject_name(x509.Name(
+            [x509.NameAttribute(NameOID.COMMON_NAME, username)])) \
+        .sign(key, hashes.SHA256())
+    with open(csr_path, "wb") as f:
+        f.write(csr.public_bytes(serialization.Encoding.PEM))
+    env_logger.debug("CSR for user %s is created in %s", username, csr_path)
 
     try:
         run(["ipa", "cert-request", csr_path, "--principal",
              username, "--certificate-out", cert_path])
     except CalledProcessError:
-        env_logger.error(f"Error while requesting the certificate for user "
-                         f"{username} from IPA server")
+        env_logger.error("Error while requesting the certificate for user %s "
+                         "from IPA server", username)
         raise
-    env_logger.debug(f"User certificate is stored to {cert_path}")
+    env_logger.debug("User certificate is stored to %s", cert_path)
 
     with open("/etc/hosts", "r") as f:
         env_logger.info(f.read())
@@ -674,19 +769,19 @@ def add_ipa_user_(user: dict, ipa_hostname: str = None):
     except Exception as e:
         env_logger.error(e)
         env_logger.error("Error while updating the kerberos password for user "
-                         f"{username} from IPA server {ipa_hostname}")
+                         "%s from IPA server %s", username, ipa_hostname)
         raise e
-    env_logger.debug(
-        f"Kerberos password for user {username} is set to {passwd}.")
+    env_logger.debug("Kerberos password for user %s is set to "
+                     "%s.", username, passwd)
 
     cmd = f"usermod -aG wheel {username}"
     run(cmd, check=True)
-    env_logger.debug(f"User {username} is added to wheel group")
+    env_logger.debug("User %s is added to wheel group", username)
 
     add_restore("user", user)
 
-    env_logger.debug(f"User {username} is updated on IPA server. "
-                     f"Cert and key stored into {user_dir}")
+    env_logger.debug("User %s is updated on IPA server. Cert and key stored "
+                     "into %s", username, user_dir)
 
 
 def setup_ipa_server_():
@@ -736,22 +831,20 @@ def general_setup(install_missing: bool, no_gdm: bool):
 
                 if pkg not in out.stdout:
                     if install_missing:
-                        env_logger.warning(
-                            f"Package {pkg} is not installed on the system. "
-                            f"Installing...")
+                        env_logger.warning("Package %s is not installed on the "
+                                           "system. Installing...", pkg)
                         run(f"dnf install {pkg} -y")
                         pkg = run(["rpm", "-qa", pkg]).stdout
-                        env_logger.debug(f"Package {pkg} is installed")
+                        env_logger.debug("Package %s is installed", pkg)
                     else:
-                        env_logger.error(
-                            f"Package {pkg} is required for testing, "
-                            "but it is not installed on the system.")
+                        env_logger.error("Package %s is required for testing, "
+                                         "but it is not installed on the "
+                                         'system.', pkg)
                         raise SCAutolibException(
                             f"Package {pkg} is required for testing, but it is "
                             f"not installed on the system.")
                 else:
-                    env_logger.debug(
-                        f"Package {out.stdout.strip()} is present")
+                    env_logger.debug("Package %s is present", out.stdout.strip())
             run(['dnf', 'groupinstall', "Smart Card Support", '-y'])
 
             env_logger.debug("Smart Card Support group in installed.")
@@ -786,6 +879,9 @@ def create_sc(sc_user: dict):
         create_dir(d, False)
     create_softhsm2_config(card_dir)
     create_virt_card_service(name, card_dir)
+    prepare_pcscd_service()
+    if sc_user.get("local"):
+        add_sssd_certmap([name])
     setup_virt_card_(sc_user)
 
 
@@ -798,9 +894,8 @@ def check_config(conf: str) -> bool:
     Return:
         True if config file contain everything what is needed. Otherwise, False.
     """
-    with open(conf, "r") as file:
-        config_data = yaml.load(file, Loader=yaml.FullLoader)
-        assert config_data, "Data are not loaded correctly."
+    config_data = _load_config_cached(conf)
+    assert config_data, "Data are not loaded correctly."
     result = True
     fields = ("root_passwd", "ca_dir", "ipa_server_root",
               "ipa_server_hostname", "ipa_client_hostname", "ipa_domain",
@@ -808,13 +903,18 @@ def check_config(conf: str) -> bool:
     config_fields = config_data.keys()
     for f in fields:
         if f not in config_fields:
-            env_logger.warning(f"Field {f} is not present in the config.")
+            env_logger.warning("Field %s is not present in the config.", f)
             result = False
     if result:
         env_logger.info("Configuration file is OK.")
     return result
 
 
+# Restore items collected by add_restore and not yet written to the library
+# configuration file.
+_PENDING_RESTORES = []
+
+
 def add_restore(type_: str, src: str or dict, backup: str = None):
     """Add new item to be restored in the cleanup phase.
 
@@ -826,22 +926,82 @@ def add_restore(type_: str, src: str or dict, backup: str = None):
              should be username
         backup: applicable only for file and dir type. Path where original
                 source was placed.
-    """
-    with open(LIB_CONF, "r") as f:
-        data = yaml.load(f, Loader=yaml.FullLoader)
-        assert data
 
+    Note: items are buffered in memory and written to the configuration file
+    by flush_restores (called on process exit or explicitly).
+    """
     if type_ not in ("user", "file", "dir"):
-        env_logger.warning(f"Type {type_} is not known, so this item can't be "
-                           f"correctly restored")
-    data["restore"].append({"type": type_, "src": src, "backup_dir": backup})
-
+        env_logger.warning("Type %s is not known, so this item can't be "
+                           "correctly restored", type_)
+    _PENDING_RESTORES.append(
+        {"type": type_, "src": src, "backup_dir": backup})
+
+
+def flush_restores():
+    """Write all pending restore items to the library configuration file.
+    All items collected by add_restore since the last flush are stored with
+    a single read-modify-write of the file. Registered as an atexit hook, so
+    pending items are not lost when the CLI exits."""
+    if not _PENDING_RESTORES:
+        return
+    data = _load_config_cached(LIB_CONF)
+    assert data
+    data["restore"].extend(_PENDING_RESTORES)
+    _PENDING_RESTORES.clear()
+
+    _drop_config_cache(LIB_CONF)
     with open(LIB_CONF, "w") as f:
-        yaml.dump(data, f)
+        yaml.dump(data, f, Dumper=_YamlDumper)
+
+
+atexit.register(flush_restores)
+
+
+# Directories larger than this (in bytes) are restored through a tar pipe
+# instead of a file-by-file copy.
+_TAR_RESTORE_THRESHOLD = 1024 * 1024
+
+
+def _dir_size(path: str) -> int:
+    """Return total size in bytes of all files in given directory tree."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            total += os.path.getsize(join(root, name))
+    return total
+
+
+def _same_device(path: str, other: str) -> bool:
+    """Check if two paths live on the same filesystem, so one can be renamed
+    over the other instead of copying the data."""
+    try:
+        return os.stat(path).st_dev == os.stat(other).st_dev
+    except OSError:
+        return False
+
+
+def _restore_dir(backup_dir: str, src: str):
+    """Restore directory from its backup. Large directories are streamed
+    through a tar pipe, which issues sequential large-block reads/writes
+    instead of per-file Python-level copies; small ones go through copytree.
+
+    Args:
+        backup_dir: directory where backup is placed
+        src: original location of the directory to be restored
+    """
+    if _dir_size(backup_dir) > _TAR_RESTORE_THRESHOLD:
+        os.makedirs(src, exist_ok=True)
+        run(["bash", "-c", f"tar -C {shlex.quote(backup_dir)} -cf - . | "
+                           f"tar -C {shlex.quote(src)} -xpf -"], check=True)
+    else:
+        copytree(backup_dir, src)
 
 
 def cleanup_():
     """Cleans the system after library setup testing environment."""
+    import python_freeipa as pipa
+
+    flush_restores()
     restore_items = read_config("restore", which="lib")
     for item in restore_items:
         type_ = item['type']
@@ -849,45 +1009,79 @@ def cleanup_():
         backup_dir = item["backup_dir"] if "backup_dir" in item.keys(
         ) else None
 
+        # Restoring by rename consumes the backup, and the restore list may
+        # contain duplicated entries after repeated prepare runs, so skip
+        # entries whose backup is already gone instead of failing.
         if type_ == "file":
             if backup_dir:
-                copyfile(backup_dir, src)
-                env_logger.debug(f"File {src} is restored form {backup_dir}")
+                if not exists(backup_dir):
+                    env_logger.warning("Backup %s is already consumed. Skip "
+                                       "restore of %s", backup_dir, src)
+                    continue
+                if _same_device(backup_dir, os.path.dirname(src) or "/"):
+                    os.replace(backup_dir, src)
+                else:
+                    copyfile(backup_dir, src)
+                # Renamed inode keeps the label of the backup directory
+                run(["restorecon", "-v", src])
+                env_logger.debug("File %s is restored form %s", src, backup_dir)
             else:
                 remove(src)
-                env_logger.debug(f"File {src} is deleted")
+                env_logger.debug("File %s is deleted", src)
         elif type_ == "dir":
+            if backup_dir and not exists(backup_dir):
+                env_logger.warning("Backup %s is already consumed. Skip "
+                                   "restore of %s", backup_dir, src)
+                continue
             rmtree(src, ignore_errors=True)
-            env_logger.debug(f"Directory {src} is deleted")
+            env_logger.debug("Directory %s is deleted", src)
             if backup_dir:
-                copytree(backup_dir, src)
-                env_logger.debug(
-                    f"Directory {src} is restored form {backup_dir}")
+                if _same_device(backup_dir, os.path.dirname(src) or "/"):
+                    os.replace(backup_dir, src)
+                else:
+                    _restore_dir(backup_dir, src)
+                run(["restorecon", "-Rv", src])
+                env_logger.debug("Directory %s is restored form "
+                                 "%s", src, backup_dir)
         elif type_ == "user":
             username = src["name"]
             run(["pkill", "-u", username], check=False)
-            env_logger.debug(
-                f"All processes owned by user {src} are killed.")
+            env_logger.debug("All processes owned by user %s are killed.", src)
             if src["local"]:
                 run(["userdel", username, "-r"])
-                env_logger.debug(f"Local user {username} is removed.")
+                env_logger.debug("Local user %s is removed.", username)
             else:
                 ipa_admin_passwd, ipa_hostname = read_config(
                     "ipa_server_admin_passwd", "ipa_server_hostname")
                 client = pipa.ClientMeta(ipa_hostname, verify_ssl=False)
                 client.login("admin", ipa_admin_passwd)
                 client.user_del(username, o_preserve=False)
-                env_logger.debug(
-                    f"IPA user {username} is remove from the IPA server.")
+                env_logger.debug("IPA user %s is remove from the IPA "
+                                 "server.", username)
         elif type_ == "host":
             ipa_admin_passwd, ipa_hostname = read_config(
                 "ipa_server_admin_passwd", "ipa_server_hostname")
             client = pipa.ClientMeta(ipa_hostname, verify_ssl=False)
             client.login("admin", ipa_admin_passwd,)
             client.host_del(src, o_updatedns=True)
-            env_logger.debug(f"Host {src} is delete from IPA server.")
+            env_logger.debug("Host %s is delete from IPA server.", src)
         else:
-            env_logger.warning(f"Skip item with unknown type '{type_}'")
+            env_logger.warning("Skip item with unknown type '%s'", type_)
+
+
+def run_batch(commands: list, **kwargs) -> subprocess.CompletedProcess:
+    """Execute several shell commands in one bash process instead of forking
+    a new process per command. Commands are separated with ";", so each of
+    them runs regardless of the exit code of the previous one, same as if
+    they were executed by separate run() calls.
+
+    Args:
+        commands: list of shell commands to be executed by a single bash
+                  invocation.
+    Returns:
+        result of the bash invocation as subprocess.CompletedProcess
+    """
+    return run(["bash", "-c", " ; ".join(commands)], **kwargs)
 
 
 def run(cmd, stdout=PIPE, stderr=PIPE, check=False, print_=True,
@@ -1,6 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+from traceback import format_exc
+
 import click
-from SCAutolib.src import init_config
-from SCAutolib.src.env import *
+from SCAutolib.src import (LIB_CA, env_logger, init_config, load_config,
+                           read_config, set_config)
+from SCAutolib.src.env import (add_ipa_user_, check_config, cleanup_,
+                               create_cnf, create_dir, create_sc,
+                               create_sssd_config, general_setup,
+                               install_ipa_client_, prepare_dirs,
+                               prepare_pcscd_service, run, setup_ca_,
+                               setup_ipa_server_)
 
 
 @click.group()
@@ -49,6 +58,7 @@ def prepare(cards, conf, ipa, server_ip, ca, install_missing, server_hostname,
     prepare_dirs()
     env_logger.info("Directories are created")
     init_config(conf)
+    cfg = load_config()
     env_logger.info("Initialisation of library configuration files is "
                     "completed.")
     env_logger.info("Start general setup")
@@ -67,14 +77,14 @@ def prepare(cards, conf, ipa, server_ip, ca, install_missing, server_hostname,
                 env_logger.debug("No IP address for IPA server is given.")
                 env_logger.debug("Try to get IP address of IPA server from "
                                  "configuration file.")
-                server_ip = read_config("ipa_server_ip")
+                server_ip = cfg.get("ipa_server_ip")
                 if not server_ip:
                     env_logger.error("Can't find IP address of IPA server in "
                                      "configuration file")
                     exit(1)
             else:
                 set_config("ipa_server_ip", server_ip)
-            server_root_passwd = read_config("ipa_server_root")
+            server_root_passwd = cfg.get("ipa_server_root")
             install_ipa_client_(server_ip, server_root_passwd, server_hostname)
             env_logger.info("IPA client is installed on the system")
         except:
@@ -89,21 +99,30 @@ def prepare(cards, conf, ipa, server_ip, ca, install_missing, server_hostname,
         setup_ca_()
 
     if cards:
+        sc_users = []
         if ca:
-            user = read_config("local_user")
-            env_logger.info(
-                f"Start setup of virtual smart cards for local user {user}")
-            create_sc(user)
-            env_logger.info(f"Setup of virtual smart card for user {user} "
-                            f"is completed")
+            sc_users.append(cfg.get("local_user"))
         if ipa:
-            user = read_config("ipa_user")
+            user = cfg.get("ipa_user")
             add_ipa_user_(user, server_hostname)
-            env_logger.info(
-                f"Start setup of virtual smart cards for IPA user {user}")
+            sc_users.append(user)
+
+        def setup_user_card(user):
+            env_logger.info("Start setup of virtual smart cards for user "
+                            "%s", user)
             create_sc(user)
-            env_logger.info(f"Setup of virtual smart card for user {user} "
-                            f"is completed")
+            env_logger.info("Setup of virtual smart card for user %s is "
+                            "completed", user)
+
+        if sc_users:
+            # The pcscd unit is user-independent, so install it once before
+            # the workers start.
+            prepare_pcscd_service()
+            # Per-user setup is dominated by blocking I/O and process waits,
+            # so users can be set up in parallel.
+            with ThreadPoolExecutor(
+                    max_workers=min(8, len(sc_users))) as executor:
+                list(executor.map(setup_user_card, sc_users))
     env_logger.info("Preparation of the environments is completed")
     exit(0)
 
@@ -149,12 +168,12 @@ def setup_virt_card(username, key, cert, card_dir, password, local):
     if user is None:
         if not all([key, cert, username, card_dir, password, local]):
             env_logger.error("Not all required parameters are set for adding "
-                             f"virtual smart card to user {username}. "
-                             f"Add all parameters via configuration file or via"
-                             f"CLI parameters.")
+                             "virtual smart card to user %s. "
+                             "Add all parameters via configuration file or via"
+                             "CLI parameters.", username)
             exit(1)
-        env_logger.debug(f"User {username} is not in the configuration file. "
-                         f"Using values from parameters")
+        env_logger.debug("User %s is not in the configuration file. Using "
+                         "values from parameters", username)
         user = dict()
         user["name"] = username
         user["key"] = key
@@ -194,13 +213,14 @@ def setup_ipa_server(ip):
 @click.command()
 @click.option("--ip", "-i", default='', help="IP address of IPA server.")
 def install_ipa_client(ip):
+    cfg = load_config()
     if not ip:
-        ip = read_config("ipa_server_ip")
+        ip = cfg.get("ipa_server_ip")
     if ip is None:
         msg = "No IP address for IPA server is provided. Can't continue..."
         env_logger.error(msg)
         exit(1)
-    root_passwd = read_config("ipa_server_root")
+    root_passwd = cfg.get("ipa_server_root")
     install_ipa_client_(ip, root_passwd)
 
 
@@ -213,10 +233,10 @@ def install_ipa_client(ip):
               help="User directory to create on the system for placing cert and"
                    "private key from IPA server.")
 def add_ipa_user(username, user_dir):
-    user = read_config(username)
+    user = load_config().get(username)
     if user is None:
-        env_logger.debug(f"User {username} is not present in the configuration "
-                         f"file. Creating a new one")
+        env_logger.debug("User %s is not present in the configuration file. "
+                         "Creating a new one", username)
         if user_dir is None:
             env_logger.error("No user directory is specified. Exit")
             exit(1)
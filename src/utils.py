@@ -2,10 +2,9 @@ import datetime
 import re
 import subprocess as subp
 
-import paramiko
 import sys
 from configparser import RawConfigParser
-from os import listdir
+from os import link, listdir
 from os.path import isdir, isfile, join, basename, exists
 from random import randint
 from shutil import copy2, copytree
@@ -15,10 +14,6 @@ import pexpect
 from SCAutolib import env_logger, base_logger
 from SCAutolib.src import env, LIB_CA, LIB_BACKUP, LIB_CERTS, LIB_KEYS
 from SCAutolib.src.exceptions import *
-from cryptography import x509
-from cryptography.hazmat.primitives import hashes, serialization
-from cryptography.hazmat.primitives.asymmetric import rsa
-from cryptography.x509.oid import NameOID
 from decouple import UndefinedValueError
 from hashlib import md5
 
@@ -49,7 +44,18 @@ def backup_(file_path):
         return target
 
     if isfile(file_path):
-        target = copy2(file_path, target)
+        try:
+            # Hard link preserves the original bytes without reading them.
+            # Safe because backed up files are later replaced via rename,
+            # not truncated in place. The link shares the inode with the
+            # original, so no restorecon here: relabeling the backup would
+            # relabel the live file as well.
+            link(file_path, target)
+            base_logger.debug(f"Source from {file_path} is linked to {target}")
+            return target
+        except OSError:
+            # Cross-device link; fall back to a plain copy
+            target = copy2(file_path, target)
     elif isdir(file_path):
         target = copytree(file_path, target)
     env.run(f"restorecon -v {target}")
@@ -136,6 +142,13 @@ def generate_cert(username=None):
     Returns:
         tuple with path to the certificate and to the key files.
     """
+    # cryptography is expensive to import, so pull it in only when
+    # certificates are actually generated.
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from cryptography.x509.oid import NameOID
+
     prefix = username if username == "root" else "User"
     key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
     serial = randint(1, 1000)
@@ -336,9 +349,10 @@ def check_output(output: str, expect=None, reject=None,
     return True
 
 
-class PKeyChild(paramiko.PKey):
-    """This child class is need to fix SSH connection with MD5 algorith
-    in FIPS mode
+class PKeyChild:
+    """Holds replacement method for paramiko.PKey to fix SSH connection with
+    MD5 algorith in FIPS mode. The method is assigned onto paramiko.PKey by
+    the caller, so this module does not need to import paramiko itself.
 
     This is just workaround until PR in paramiko would be accepted
     https://github.com/paramiko/paramiko/issues/396. After this PR is merged,
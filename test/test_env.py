@@ -122,6 +122,7 @@ def test_add_restore(loaded_env):
     dest = '/dest/some.file'
 
     add_restore("file", src, dest)
+    flush_restores()
 
     with open(LIB_CONF, "r") as f:
         data = load(f, Loader=FullLoader)
@@ -138,6 +139,7 @@ def test_add_restore(loaded_env):
 def test_add_restore_wrong_type(caplog, loaded_env):
     add_restore("file", "src", "dest")
     add_restore("wrong_type", "src", "dest")
+    flush_restores()
 
     with open(LIB_CONF, "r") as f:
         data = load(f, Loader=FullLoader)